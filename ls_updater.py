@@ -1,18 +1,25 @@
 #!/usr/bin/env python3
 
 import datetime
+import errno
+import grp
+import hashlib
 import json
 import logging.handlers
 import os
+import pwd
 import re
 import shutil
+import stat
 import subprocess
 import sys
+import threading
+import zipfile
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
 
 import requests
-import wget
-from bs4 import BeautifulSoup
+from selectolax.parser import HTMLParser
 
 """
     ls_updater: LimeSurvey update assistant 
@@ -25,6 +32,44 @@ from bs4 import BeautifulSoup
 
 config = {}
 
+# 1 MiB I/O buffer for file reads/writes and shutil copies (the 8 KiB default is far too small for release archives)
+BUFFER_SIZE = 1 << 20
+
+# config.json validation
+EXPECTED_OPTIONS = frozenset(["branch", "db_cnf_path", "db_name", "db_port", "db_server", "install_octal_permissions",
+                              "install_owner", "install_path", "log_to_file", "log_to_stdout", "log_to_syslog",
+                              "web_server_init_system", "web_server_service"])
+VALID_BRANCHES = frozenset(["lts", "unstable", "dev"])
+
+# web server service command for each supported init system, given the service name and the action
+INIT_SYSTEM_COMMANDS = {
+    "systemd": lambda service, action: ["systemctl", action, service],
+    "systemctl": lambda service, action: ["systemctl", action, service],
+    "service": lambda service, action: ["service", service, action],
+    "generic": lambda service, action: ["service", service, action],
+    "init.d": lambda service, action: ["/etc/init.d/" + service, action],
+    "openrc": lambda service, action: ["/etc/init.d/" + service, action],
+    "rc.d": lambda service, action: ["/etc/rc.d/" + service, action],
+    "upstart": lambda service, action: ["initctl", action, service],
+    "finit": lambda service, action: ["initctl", action, service],
+    "initctl": lambda service, action: ["initctl", action, service],
+    "epoch": lambda service, action: ["epoch", action, service],
+}
+VALID_INIT_SYSTEMS = frozenset(INIT_SYSTEM_COMMANDS)
+
+# release zips smaller than this are extracted in-process rather than with a process pool
+PARALLEL_EXTRACT_MIN_SIZE = 8 << 20
+
+# validators of the last releases page that led to an up-to-date install, for conditional requests
+LISTING_CACHE_PATH = "ls_downloads/.listing_cache.json"
+
+# verified release zip and the folder it was extracted to, so an interrupted run can reuse both
+DOWNLOAD_CACHE_PATH = "ls_downloads/.cache.json"
+
+# versionnumber and buildnumber from limesurvey/application/config/version.php, matched in one pass
+VERSION_PATTERN = re.compile(r"\$config\['versionnumber'\]\s*=\s*'(?P<version>[^']+)'.*?"
+                             r"\$config\['buildnumber'\]\s*=\s*'?(?P<build>[^';]*)'?\s*;", re.S)
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 formatter = logging.Formatter("%(asctime)s {%(filename)s:%(lineno)d} [%(levelname)s]: %(message)s")
@@ -59,50 +104,329 @@ def __log_setup(stdout, syslog, file):
         file_handler.setLevel(logging.INFO)
         log.addHandler(file_handler)
     if stdout or syslog or file:
-        log.debug("Set up logger. Stdout: " + str(stdout) + ", Syslog: " + str(syslog) + ", File: " + str(file))
+        log.debug("Set up logger. Stdout: %s, Syslog: %s, File: %s", stdout, syslog, file)
         log.info("================================")
-        log.info("New run started at: " + str(datetime.datetime.now()))
+        log.info("New run started at: %s", datetime.datetime.now())
         log.info("================================")
 
 
 def validate_config(config_input):
     if config_input is None or len(config_input) < 1:
         raise RuntimeError("Config may exist, but is apparently empty.")
-    expected_options = ["branch", "db_cnf_path", "db_name", "db_port", "db_server", "install_octal_permissions",
-                        "install_owner", "install_path", "log_to_file", "log_to_stdout", "log_to_syslog",
-                        "web_server_init_system", "web_server_service"]
-    for option in expected_options:
-        if config[option] is None or config[option] == "":
-            raise RuntimeError("Config validation error: empty " + option)
-    if config['branch'] not in ["lts", "unstable", "dev"]:
+    missing = EXPECTED_OPTIONS - config_input.keys()
+    if missing:
+        raise RuntimeError("Config validation error: missing " + ", ".join(sorted(missing)))
+    empty = [option for option in sorted(EXPECTED_OPTIONS)
+             if config_input[option] is None or config_input[option] == ""]
+    if empty:
+        raise RuntimeError("Config validation error: empty " + ", ".join(empty))
+    if config_input['branch'] not in VALID_BRANCHES:
         raise RuntimeError("Config validation error: branch not one of 'lts', 'unstable', 'dev': "
-                           + str(config['branch']))
-    elif not os.path.exists(config['install_path']):
+                           + str(config_input['branch']))
+    elif not os.path.exists(config_input['install_path']):
         raise RuntimeError("Config validation error: install_path does not exist.")
     # elif not os.access(config['db_cnf_path'], os.R_OK):
     #     raise RuntimeError(
     #         "Config validation error: db_cnf_path does not allow read permission: " + str(config['db_cnf_path']))
-    elif not os.access(config['install_path'], os.W_OK | os.X_OK):
+    elif not os.access(config_input['install_path'], os.W_OK | os.X_OK):
         raise RuntimeError(
             "Config validation error: install_path does not allow write and execute permissions: "
-            + str(config['install_path']))
-    elif not config["web_server_init_system"] in ['generic', 'service', 'systemd', 'systemctl', 'init.d', 'openrc',
-                                                  'rc.d', 'upstart', 'finit', 'initctl', 'epoch']:
+            + str(config_input['install_path']))
+    if not isinstance(config_input.get("full_backup", False), bool):
+        raise RuntimeError("Config validation error: full_backup must be true or false: "
+                           + str(config_input["full_backup"]))
+    try:
+        # resolve now, as ownership is only applied after the old install has been deleted
+        parse_owner(config_input["install_owner"])
+    except Exception as e:
+        raise RuntimeError("Config validation error: install_owner cannot be resolved: "
+                           + str(config_input["install_owner"]) + " (" + str(e) + ")")
+    # parsed once here and stored back as an int, which run() applies as is
+    octal_permissions = str(config_input["install_octal_permissions"])
+    if re.fullmatch(r"[0-7]+", octal_permissions) is None or int(octal_permissions, 8) > 0o7777:
+        raise RuntimeError("Config validation error: install_octal_permissions is not an octal mode between "
+                           "0 and 7777: " + octal_permissions)
+    config_input["install_octal_permissions"] = int(octal_permissions, 8)
+    if config_input["web_server_init_system"] not in VALID_INIT_SYSTEMS:
         raise RuntimeError("Config validation error: web_server_init_system not one of "
                            "'generic' (or 'service'), systemd, 'init.d' (or 'openrc'), 'rc.d', "
-                           "'upstart' (or 'finit'), or 'epoch': " + str(config['branch']))
+                           "'upstart' (or 'finit'), or 'epoch': " + str(config_input['web_server_init_system']))
+    return True
+
+
+def __extract_entries(zip_path, names, destination):
+    """Write some files of a zip to disk with their own ZipFile handle, so this can run in a worker process
+    :param zip_path: Path to the zip
+    :param names: Names of the file entries to extract (their folders must already exist)
+    :param destination: Folder to extract into
+    """
+    with zipfile.ZipFile(zip_path) as z:
+        for name in names:
+            with z.open(name) as source, open(os.path.join(destination, name), "wb", buffering=BUFFER_SIZE) as dest:
+                shutil.copyfileobj(source, dest, length=BUFFER_SIZE)
+
+
+def extract_release(zip_path, destination, skip=("upload",)):
+    """Stream the entries of a release zip into a folder, decompressing on all cores for large archives
+    :param zip_path: Path to the downloaded release zip
+    :param destination: Folder to extract into
+    :param skip: Application folders to leave out (upload/ is restored from the backup instead)
+    """
+    destination = os.path.abspath(destination)
+    files = []
+    with zipfile.ZipFile(zip_path) as z:
+        for info in z.infolist():
+            # entries look like limesurvey/upload/...; the first part is the release folder
+            parts = info.filename.split("/")
+            if len(parts) > 1 and parts[1] in skip:
+                continue
+            target = os.path.abspath(os.path.join(destination, info.filename))
+            if os.path.commonpath([destination, target]) != destination:
+                raise RuntimeError("Zip entry points outside of the extraction folder: " + info.filename)
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            files.append(info)
+    workers = os.cpu_count() or 1
+    # below this size starting the worker processes costs more than the decompression they save
+    if workers == 1 or os.path.getsize(zip_path) < PARALLEL_EXTRACT_MIN_SIZE:
+        __extract_entries(zip_path, [info.filename for info in files], destination)
+        return
+    # deal the entries out largest first so every worker gets a similar amount of data to inflate
+    chunks = [[] for _ in range(workers)]
+    for index, info in enumerate(sorted(files, key=lambda entry: entry.compress_size, reverse=True)):
+        chunks[index % workers].append(info.filename)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        tasks = [pool.submit(__extract_entries, zip_path, chunk, destination) for chunk in chunks if chunk]
+        for task in tasks:
+            task.result()
+
+
+def archive_install(source, base_name, start_process=subprocess.Popen):
+    """Archive a folder, compressing on all cores with pigz when it is available
+    :param source: Folder to archive
+    :param base_name: Path of the archive without its extension
+    :param start_process: Popen-compatible callable used to start tar and pigz, so a caller can track and stop them
+    :return: Path of the created archive (.tar.gz with pigz, otherwise .zip)
+    """
+    pigz = shutil.which("pigz")
+    if pigz is None or shutil.which("tar") is None:
+        return shutil.make_archive(base_name, "zip", source)
+    archive = base_name + ".tar.gz"
+    with open(archive, "wb", buffering=BUFFER_SIZE) as out:
+        tar_process = start_process(["tar", "-C", source, "-cf", "-", "."], stdout=subprocess.PIPE)
+        try:
+            pigz_process = start_process([pigz, "-p", str(os.cpu_count() or 1), "-c"], stdin=tar_process.stdout,
+                                         stdout=out)
+        except Exception:
+            tar_process.kill()
+            tar_process.wait()
+            raise
+        finally:
+            tar_process.stdout.close()
+        pigz_process.wait()
+        tar_process.wait()
+    for process in (tar_process, pigz_process):
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+    return archive
+
+
+def __copy_in_kernel(copy_chunk, chunk_size, size):
+    """Run a kernel copy call until EOF
+    :param copy_chunk: Callable copying up to the given number of bytes and returning how many were copied
+    :param chunk_size: Number of bytes requested per call
+    :param size: Size of the source file
+    :return: False if the kernel or filesystem does not support this kind of copy
+    """
+    copied = 0
+    try:
+        while True:
+            count = copy_chunk(chunk_size)
+            if count == 0:
+                break
+            copied += count
+    except OSError as e:
+        if e.errno in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+            return False
+        raise
+    # some kernel/filesystem combinations report EOF straight away instead of failing
+    if copied == 0 and size > 0:
+        return False
     return True
 
 
+def copy_file(source, destination):
+    """Copy a file without passing its contents through Python where possible, then copy its metadata.
+    Tries os.copy_file_range, then os.sendfile, then a buffered copyfileobj.
+    :param source: File to copy
+    :param destination: Path of the copy
+    :return: The destination, so this can be used as a shutil copy_function
+    """
+    # O_NONBLOCK so that a FIFO is rejected below instead of blocking the open
+    source_fd = os.open(source, os.O_RDONLY | os.O_NONBLOCK)
+    source_stat = os.fstat(source_fd)
+    if not stat.S_ISREG(source_stat.st_mode):
+        os.close(source_fd)
+        raise shutil.SpecialFileError("`" + str(source) + "` is not a regular file")
+    with open(source_fd, "rb", buffering=0) as src, open(destination, "wb", buffering=0) as dst:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        size = source_stat.st_size
+        chunk_size = min(max(size, BUFFER_SIZE), 1 << 30)
+        copied = False
+        if hasattr(os, "copy_file_range"):
+            copied = __copy_in_kernel(lambda count: os.copy_file_range(src_fd, dst_fd, count), chunk_size, size)
+        if not copied and hasattr(os, "sendfile"):
+            copied = __copy_in_kernel(lambda count: os.sendfile(dst_fd, src_fd, None, count), chunk_size, size)
+        if not copied:
+            shutil.copyfileobj(src, dst, length=BUFFER_SIZE)
+        copied_size = os.fstat(dst_fd).st_size
+        if copied_size != size:
+            raise OSError(errno.EIO, "Copied " + str(copied_size) + " of " + str(size) + " bytes", source)
+    shutil.copystat(source, destination)
+    return destination
+
+
+def parallel_copytree(source, destination, workers=8):
+    """Copy a folder tree, overlapping the per-file copies on a thread pool
+    :param source: Folder to copy
+    :param destination: Folder to copy into (created if missing, existing files are overwritten)
+    :param workers: Number of files copied at the same time
+    """
+    folders = []
+    files = []
+    pending = [(source, destination)]
+    while pending:
+        source_folder, destination_folder = pending.pop()
+        os.makedirs(destination_folder, exist_ok=True)
+        folders.append((source_folder, destination_folder))
+        with os.scandir(source_folder) as entries:
+            for entry in entries:
+                target = os.path.join(destination_folder, entry.name)
+                if entry.is_dir():
+                    pending.append((entry.path, target))
+                elif entry.is_file():
+                    files.append((entry.path, target))
+                else:
+                    # FIFOs, sockets, devices and dangling symlinks, which shutil.copytree also refuses
+                    raise shutil.SpecialFileError("`" + entry.path + "` is not a regular file")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # consume the results so that the first failed copy is raised
+        list(pool.map(lambda task: copy_file(*task), files))
+    # folder metadata last, as writing the files into them updates their mtimes
+    for source_folder, destination_folder in folders:
+        shutil.copystat(source_folder, destination_folder)
+
+
+def parse_owner(owner):
+    """Resolve a chown-style owner into numeric ids, accepting names or numeric ids like chown does
+    :param owner: "user:group", "user:" (the user's login group), "user" or ":group" (the other id is left unchanged)
+    :return: Tuple of (uid, gid), where -1 means unchanged
+    """
+    user, separator, group = owner.partition(":")
+    if not user and not group:
+        raise ValueError("Owner has neither a user nor a group: " + owner)
+    uid = -1
+    if user:
+        uid = int(user) if user.isdigit() else pwd.getpwnam(user).pw_uid
+    if group:
+        gid = int(group) if group.isdigit() else grp.getgrnam(group).gr_gid
+    elif separator:
+        gid = pwd.getpwuid(uid).pw_gid
+    else:
+        gid = -1
+    return uid, gid
+
+
+def apply_ownership_and_permissions(path, uid, gid, mode):
+    """Recursively chown and chmod a folder tree in a single walk, like chown -R and chmod -R.
+    Symlinks get their own ownership changed but are never followed or chmodded.
+    :param path: Root of the tree
+    :param uid: Owner user id
+    :param gid: Owner group id
+    :param mode: Permission bits applied to every folder and file
+    """
+    for root, dirs, files, root_fd in os.fwalk(path):
+        os.fchown(root_fd, uid, gid)
+        os.fchmod(root_fd, mode)
+        # fwalk lists symlinks to folders in dirs without walking into them
+        for name in dirs:
+            if stat.S_ISLNK(os.stat(name, dir_fd=root_fd, follow_symlinks=False).st_mode):
+                os.chown(name, uid, gid, dir_fd=root_fd, follow_symlinks=False)
+        for name in files:
+            try:
+                fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=root_fd)
+            except OSError as e:
+                if e.errno == errno.ELOOP:
+                    os.chown(name, uid, gid, dir_fd=root_fd, follow_symlinks=False)
+                    continue
+                raise
+            try:
+                os.fchown(fd, uid, gid)
+                os.fchmod(fd, mode)
+            finally:
+                os.close(fd)
+
+
+def sha256_file(path):
+    """Hash a file on disk
+    :param path: Path of the file to hash
+    :return: Hex SHA-256 digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_cache(path):
+    """Read a JSON cache file from ls_downloads/
+    :param path: LISTING_CACHE_PATH or DOWNLOAD_CACHE_PATH
+    :return: The cached dict, or an empty dict if nothing is cached
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", buffering=BUFFER_SIZE) as f:
+        return json.load(f)
+
+
+def save_cache(path, data):
+    """Write a JSON cache file to ls_downloads/
+    :param path: LISTING_CACHE_PATH or DOWNLOAD_CACHE_PATH
+    :param data: Dict to cache
+    """
+    if not os.path.exists("ls_downloads"):
+        os.makedirs("ls_downloads")
+    with open(path, "w", buffering=BUFFER_SIZE) as f:
+        json.dump(data, f, indent=4)
+
+
+def save_listing_cache(response, version_code, branch):
+    """Remember the validators of a releases page response together with the version it left installed
+    :param response: Response for the releases page
+    :param version_code: LimeSurvey version installed once the run completes
+    :param branch: Branch that version was selected from
+    """
+    save_cache(LISTING_CACHE_PATH, {"version_code": version_code,
+                                    "branch": branch,
+                                    "etag": response.headers.get("ETag"),
+                                    "last_modified": response.headers.get("Last-Modified")})
+
+
 #######################
 # Run the main script #
 #######################
 
 def run():
     global config, log
+    shutil.COPY_BUFSIZE = BUFFER_SIZE
     # load the configuration
     try:
-        with open(os.path.normpath(Path(__file__).parent.absolute()) + "/" + "config.json", "r") as file:
+        with open(os.path.normpath(Path(__file__).parent.absolute()) + "/" + "config.json", "r",
+                  buffering=BUFFER_SIZE) as file:
             config = json.load(file)
         validate_config(config)
         __log_setup(config["log_to_stdout"], config["log_to_syslog"], config['log_to_file'])
@@ -114,37 +438,57 @@ def run():
     version_code = ""
     major_version = 0
     try:
-        with open(config["install_path"] + "/application/config/version.php", "r") as f:
-            current_version = f.read().split("$config['versionnumber'] = '")[1].split("';\n$config")[0]
-            f.close()
-            # Get the major version number by extracting the first number which is followed by a period
-            major_version = int(re.search(r"(\d+)\.", current_version).group(1))
-            if major_version <= 0:
-                log.error("Error determining major version. Now exiting.")
-        with open(config["install_path"] + "/application/config/version.php", "r") as f:
-            current_build = f.read().split("$config['buildnumber'] = ")[1].split(";\n$config")[0].strip("'")
-            f.close()
+        with open(config["install_path"] + "/application/config/version.php", "r", buffering=BUFFER_SIZE) as f:
+            version_file = f.read()
+        version_match = VERSION_PATTERN.search(version_file)
+        if version_match is None:
+            raise RuntimeError("versionnumber and buildnumber not found in version.php")
+        current_version = version_match["version"]
+        current_build = version_match["build"].strip()
+        # Get the major version number by extracting the first number which is followed by a period
+        major_version = int(re.search(r"(\d+)\.", current_version).group(1))
+        if major_version <= 0:
+            log.error("Error determining major version. Now exiting.")
         version_code = current_version + "+" + current_build
-        log.info("Current LimeSurvey version: " + version_code)
+        log.info("Current LimeSurvey version: %s", version_code)
     except Exception as e:
-        log.error("Unable to determine current LimeSurvey version. Now exiting. Full error: " + str(e))
+        log.error("Unable to determine current LimeSurvey version. Now exiting. Full error: %s", e)
         exit(1)
 
+    # one keep-alive session so the listing and the download share a pooled connection
+    session = requests.Session()
+    session.headers["Connection"] = "keep-alive"
+
+    # only revalidate against a cached page if it was cached for the installed version and the configured branch
+    listing_headers = {}
+    try:
+        listing_cache = load_cache(LISTING_CACHE_PATH)
+        if listing_cache.get("version_code") == version_code and listing_cache.get("branch") == config["branch"]:
+            if listing_cache.get("etag"):
+                listing_headers["If-None-Match"] = listing_cache["etag"]
+            if listing_cache.get("last_modified"):
+                listing_headers["If-Modified-Since"] = listing_cache["last_modified"]
+    except Exception as e:
+        log.info("Ignoring unreadable releases page cache %s. Full error: %s", LISTING_CACHE_PATH, e)
+
     log.info("Retrieving latest releases from https://community.limesurvey.org/downloads/")
     page = None
     try:
-        page = requests.get("https://community.limesurvey.org/downloads/")
+        page = session.get("https://community.limesurvey.org/downloads/", headers=listing_headers)
     except Exception as e:
-        log.error("Unable to retrieve releases page. Now exiting. Full error: " + str(e))
+        log.error("Unable to retrieve releases page. Now exiting. Full error: %s", e)
         exit(1)
+    if page.status_code == 304:
+        log.info("No need to upgrade. Releases page has not changed since the last check for %s.", version_code)
+        exit(0)
 
     log.info("Parsing releases page...")
     releases = []
     try:
-        soup = BeautifulSoup(page.content, "html.parser")
-        rows = soup.find_all("a", {"class": ["release-button"]})
+        tree = HTMLParser(page.content)
+        rows = tree.css("a.release-button")
         for num, row in enumerate(rows):
-            url = row.attrs["href"]
+            url = row.attributes["href"]
             if "-LTS/" in url:
                 release_type = "lts"
             elif "/latest-master" in url:
@@ -152,7 +496,7 @@ def run():
             elif "/latest-" in url:
                 release_type = "dev"
             else:
-                log.error("Unable to locate release within the page HTML. Now exiting. Full error: " + str(e))
+                log.error("Unable to locate release within the page HTML. Now exiting. Unrecognized URL: %s", url)
                 exit(1)
             version = url.split("/").pop().split("limesurvey").pop().split("+")[0]
             build = url.split("/").pop().split("limesurvey").pop().split("+").pop().split(".zip")[0]
@@ -161,9 +505,10 @@ def run():
                              "type": release_type,
                              "url": url})
             url.split("/").pop()
-        log.info("Available versions: " + str(releases).replace("\n", "\t"))
+        if log.isEnabledFor(logging.INFO):
+            log.info("Available versions: %s", str(releases).replace("\n", "\t"))
     except Exception as e:
-        log.error("Unable to parse HTML of webpage for releases. Now exiting. Full error: " + str(e))
+        log.error("Unable to parse HTML of webpage for releases. Now exiting. Full error: %s", e)
         exit(1)
 
     # Select version to install
@@ -177,233 +522,334 @@ def run():
     if new_version is None:
         log.error("Unable to find compatible version. Check the logs and verify the branch set in config.json.")
         exit(1)
-    if new_version == current_version:
-        log.info("No need to upgrade. Current version is the most recent for the '" + config["branch"] + "' branch.")
+    if new_version == version_code:
+        log.info("No need to upgrade. Current version is the most recent for the '%s' branch.", config["branch"])
+        try:
+            save_listing_cache(page, version_code, config["branch"])
+        except Exception as e:
+            log.info("Unable to cache releases page validators. Full error: %s", e)
         exit(0)
-    log.info("Version to install: " + new_version)
+    log.info("Version to install: %s", new_version)
     filename = new_version + ".zip"
-    log.info("Downloading release: " + url)
-    filename_on_disk = ""
-    try:
-        if not os.path.exists("ls_downloads"):
-            os.makedirs("ls_downloads")
-        if os.path.exists("ls_downloads/" + filename):
-            log.info("Removing existing file: ls_downloads/" + filename)
-            os.remove("ls_downloads/" + filename)
-        filename_on_disk = wget.download(url, "ls_downloads/" + filename)
-    except Exception as e:
-        log.error("Unable to download. Now exiting. Full error: " + str(e))
-        exit(1)
-    log.info("Downloaded release: " + filename_on_disk)
+    filename_on_disk = "ls_downloads/" + filename
+    expected_folder_path = os.path.join("ls_downloads", new_version, "limesurvey")
 
-    log.info("Extracting release from zip: " + filename_on_disk)
+    # a previous run that stopped after downloading and extracting this release left a verified copy behind
+    zip_sha256 = None
+    download_validators = {}
+    reuse_extracted = False
     try:
-        if os.path.exists("ls_downloads/" + new_version):
-            log.info("Removing existing folder: ls_downloads/" + new_version)
-            shutil.rmtree("ls_downloads/" + new_version)
-        shutil.unpack_archive(filename_on_disk, "ls_downloads/" + new_version)
+        download_cache = load_cache(DOWNLOAD_CACHE_PATH)
+        if download_cache.get("url") == url and os.path.exists(filename_on_disk):
+            head = session.head(url, allow_redirects=True)
+            head.raise_for_status()
+            download_validators = {"etag": head.headers.get("ETag"),
+                                   "content_length": head.headers.get("Content-Length")}
+            if (any(download_validators.values())
+                    and download_validators["etag"] == download_cache.get("etag")
+                    and download_validators["content_length"] == download_cache.get("content_length")
+                    and sha256_file(filename_on_disk) == download_cache.get("zip_sha256")):
+                zip_sha256 = download_cache["zip_sha256"]
+                reuse_extracted = (download_cache.get("extracted_to") == expected_folder_path
+                                   and os.path.isdir(expected_folder_path))
     except Exception as e:
-        log.error("Unable to unzip release. Now exiting. Full error: " + str(e))
-        exit(1)
+        log.info("Not reusing a previous download. Full error: %s", e)
+    if not reuse_extracted and os.path.exists(DOWNLOAD_CACHE_PATH):
+        try:
+            os.remove(DOWNLOAD_CACHE_PATH)
+        except Exception as e:
+            log.error("Unable to remove stale download cache %s. Now exiting. Full error: %s", DOWNLOAD_CACHE_PATH, e)
+            exit(1)
+
+    if zip_sha256 is not None:
+        log.info("Reusing verified download: %s (sha256 %s)", filename_on_disk, zip_sha256)
+    else:
+        log.info("Downloading release: %s", url)
+        try:
+            if not os.path.exists("ls_downloads"):
+                os.makedirs("ls_downloads")
+            if os.path.exists(filename_on_disk):
+                log.info("Removing existing file: %s", filename_on_disk)
+                os.remove(filename_on_disk)
+            digest = hashlib.sha256()
+            with session.get(url, stream=True) as r:
+                r.raise_for_status()
+                r.raw.decode_content = True
+                download_validators = {"etag": r.headers.get("ETag"),
+                                       "content_length": r.headers.get("Content-Length")}
+                with open(filename_on_disk, "wb", buffering=BUFFER_SIZE) as f:
+                    for block in iter(lambda: r.raw.read(BUFFER_SIZE), b""):
+                        digest.update(block)
+                        f.write(block)
+            zip_sha256 = digest.hexdigest()
+        except Exception as e:
+            log.error("Unable to download. Now exiting. Full error: %s", e)
+            exit(1)
+        log.info("Downloaded release: %s (sha256 %s)", filename_on_disk, zip_sha256)
+
+    if reuse_extracted:
+        log.info("Reusing extracted release at: %s", expected_folder_path)
+    else:
+        log.info("Extracting release from zip: %s", filename_on_disk)
+        try:
+            if os.path.exists("ls_downloads/" + new_version):
+                log.info("Removing existing folder: ls_downloads/%s", new_version)
+                shutil.rmtree("ls_downloads/" + new_version)
+            extract_release(filename_on_disk, "ls_downloads/" + new_version)
+        except Exception as e:
+            log.error("Unable to unzip release. Now exiting. Full error: %s", e)
+            exit(1)
 
     log.info("Checking extracted file format...")
     try:
-        expected_folder_path = os.path.join("ls_downloads", new_version, "limesurvey")
         if os.path.exists(expected_folder_path):
-            log.info("Found folder as expected at: " + expected_folder_path)
+            log.info("Found folder as expected at: %s", expected_folder_path)
         else:
             unzipped_contents = os.listdir(os.path.join("ls_downloads", new_version))
             if len(unzipped_contents) > 1:
-                log.error("Problem with extracted zip structure - more than 1 item in directory: " + os.path.join("ls_downloads", new_version) + ", list: " + str(unzipped_contents))
+                log.error("Problem with extracted zip structure - more than 1 item in directory: %s, list: %s",
+                          os.path.join("ls_downloads", new_version), unzipped_contents)
                 exit(1)
             elif len(unzipped_contents) < 1:
-                log.error("Problem with extracted zip structure - no contents in directory: " + os.path.join("ls_downloads", new_version))
+                log.error("Problem with extracted zip structure - no contents in directory: %s",
+                          os.path.join("ls_downloads", new_version))
                 exit(1)
             else:
                 # 1 folder, as expected
                 for item in unzipped_contents:
                     folder_path = os.path.join("ls_downloads", new_version, item)
                     if os.path.isdir(folder_path):
-                        log.info("Format not exact; renaming inner folder from " + folder_path + " to " + expected_folder_path)
+                        log.info("Format not exact; renaming inner folder from %s to %s",
+                                 folder_path, expected_folder_path)
                         os.rename(folder_path, expected_folder_path)
-                        log.info("Renamed inner folder to " + expected_folder_path)
+                        log.info("Renamed inner folder to %s", expected_folder_path)
                     else:
-                        log.error("Problem with extracted zip structure - inner item not a folder, now exiting: " + folder_path)
+                        log.error("Problem with extracted zip structure - inner item not a folder, now exiting: %s",
+                                  folder_path)
                         exit(1)
     except Exception as e:
-        log.error("Problem with extracted zip structure. Now exiting. Full error: " + str(e))
+        log.error("Problem with extracted zip structure. Now exiting. Full error: %s", e)
         exit(1)
+    try:
+        save_cache(DOWNLOAD_CACHE_PATH, {"url": url,
+                                         "etag": download_validators.get("etag"),
+                                         "content_length": download_validators.get("content_length"),
+                                         "zip_sha256": zip_sha256,
+                                         "extracted_to": expected_folder_path})
+    except Exception as e:
+        log.info("Unable to cache the verified download. Full error: %s", e)
 
-    log.info("Stopping web server service: " + config["web_server_service"]
-             + " with init system: " + config["web_server_init_system"])
+    log.info("Stopping web server service: %s with init system: %s",
+             config["web_server_service"], config["web_server_init_system"])
     try:
-        if config["web_server_init_system"] in ["systemd", "systemctl"]:
-            subprocess.run(["systemctl", "stop", config["web_server_service"]], capture_output=True, check=True)
-        elif config["web_server_init_system"] in ["service", "generic"]:
-            subprocess.run(["service", config["web_server_service"], "stop"], capture_output=True, check=True)
-        elif config["web_server_init_system"] in ["init.d", "openrc"]:
-            subprocess.run(["/etc/init.d/" + config["web_server_service"], "stop"], capture_output=True, check=True)
-        elif config["web_server_init_system"] == "rc.d":
-            subprocess.run(["/etc/rc.d/" + config["web_server_service"], "stop"], capture_output=True, check=True)
-        elif config["web_server_init_system"] in ["upstart", "finit", "initctl"]:
-            subprocess.run(["initctl", "stop", config["web_server_service"]], capture_output=True, check=True)
-        elif config["web_server_init_system"] == "epoch":
-            subprocess.run(["epoch", "stop", config["web_server_service"]], capture_output=True, check=True)
+        subprocess.run(INIT_SYSTEM_COMMANDS[config["web_server_init_system"]](config["web_server_service"], "stop"),
+                       capture_output=True, check=True)
         log.info("Stopped web server.")
     except subprocess.CalledProcessError as e:
         if e.output is not None and e.output != b"":
-            log.error("Unable to stop web server cleanly. Now exiting. Full error: " + str(e)
-                      + " and command output: " + str(e.output))
+            log.error("Unable to stop web server cleanly. Now exiting. Full error: %s and command output: %s",
+                      e, e.output)
         else:
-            log.error("Unable to stop web server cleanly. Now exiting. Full error: " + str(e))
+            log.error("Unable to stop web server cleanly. Now exiting. Full error: %s", e)
         exit(1)
 
-    log.info("Backing up database: " + config["db_name"])
+    log.info("Backing up database: %s", config["db_name"])
     build_change = version_code + "_to_" + new_version
     backup_path = "ls_backup/" + build_change + "/"
     if os.path.exists(backup_path + config["db_name"] + ".sql"):
-        log.error(
-            "DB backup already exists: " + backup_path + config["db_name"] + ".sql so now exiting.")
+        log.error("DB backup already exists: %s%s.sql so now exiting.", backup_path, config["db_name"])
         exit(1)
     try:
         if not os.path.exists(backup_path):
             os.makedirs(backup_path)
     except Exception as e:
-        log.error("Unable to create directory " + backup_path + " so now exiting. Full error: " + str(e))
-        exit(1)
-    try:
-        subprocess.run(["mysqldump", "--defaults-extra-file=" + config["db_cnf_path"],
-                        "-h", config["db_server"],
-                        "-P", str(config["db_port"]),
-                        config["db_name"],
-                        "--result-file=" + backup_path + config["db_name"] + ".sql"],
-                       capture_output=True,
-                       check=True)
-    except subprocess.CalledProcessError as e:
-        if e.output is not None and e.output != b"":
-            log.error("Unable to back up database. Now exiting. Full error: " + str(e)
-                      + " and command output: " + str(e.output))
-        else:
-            log.error("Unable to back up database. Now exiting. Full error: " + str(e))
+        log.error("Unable to create directory %s so now exiting. Full error: %s", backup_path, e)
         exit(1)
+    # the database dump, the optional install archive and the copy of the files needed for restore are
+    # independent, so they run at the same time and the backup takes as long as the slowest of them
+    full_backup = config.get("full_backup", False)
+    if full_backup:
+        for extension in (".zip", ".tar.gz"):
+            if os.path.exists(backup_path + version_code + "_backup" + extension):
+                log.error("Backup already exists: %s%s_backup%s so now exiting.", backup_path, version_code, extension)
+                exit(1)
+
+    # every backup subprocess goes through start_backup_process, so a failed step can always stop the others
+    backup_processes = []
+    backup_processes_lock = threading.Lock()
+    backup_cancelled = threading.Event()
+
+    def start_backup_process(command, **kwargs):
+        with backup_processes_lock:
+            if backup_cancelled.is_set():
+                raise RuntimeError("Not started because another backup step failed: " + str(command))
+            process = subprocess.Popen(command, **kwargs)
+            backup_processes.append(process)
+            return process
+
+    def stop_backup_processes():
+        with backup_processes_lock:
+            backup_cancelled.set()
+            for process in backup_processes:
+                if process.poll() is None:
+                    process.terminate()
 
-    log.info("Backing up application files from " + config["install_path"] + " to " + backup_path)
-    if os.path.exists(backup_path + version_code + "_backup.zip"):
-        log.error("Backup already exists: " + backup_path + version_code + "_backup.zip so now exiting.")
-        exit(1)
     try:
-        shutil.make_archive(backup_path + version_code + "_backup", "zip",
-                            config["install_path"])
+        dump_process = start_backup_process(["mysqldump", "--defaults-extra-file=" + config["db_cnf_path"],
+                                             "-h", config["db_server"],
+                                             "-P", str(config["db_port"]),
+                                             config["db_name"],
+                                             "--result-file=" + backup_path + config["db_name"] + ".sql"],
+                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     except Exception as e:
-        log.error("Unable to zip and back up the current installation. Now exiting. Full error: " + str(e))
+        log.error("Unable to back up database. Now exiting. Full error: %s", e)
         exit(1)
 
-    log.info("Copying needed files for restore from " + config["install_path"] + " to "
-             + backup_path)
-    try:
-        shutil.copytree(config["install_path"] + "/upload",
-                        backup_path + "upload",
-                        symlinks=False,
-                        ignore=None,
-                        copy_function=shutil.copy2,
-                        ignore_dangling_symlinks=False,
-                        dirs_exist_ok=True)
+    def dump_database():
+        output, error_output = dump_process.communicate()
+        if dump_process.returncode != 0:
+            raise subprocess.CalledProcessError(dump_process.returncode, dump_process.args, output, error_output)
+
+    def copy_needed_files():
+        parallel_copytree(config["install_path"] + "/upload", backup_path + "upload",
+                          workers=min(os.cpu_count() or 1, 8))
         shutil.copy2(config["install_path"] + "/application/config/config.php",
                      backup_path + "config.php")
+        copied = ["upload", "config.php"]
         if major_version > 3:
             # the security file is only present in 4.x+
             shutil.copy2(config["install_path"] + "/application/config/security.php",
                          backup_path + "security.php")
+            copied.append("security.php")
+        return copied
+
+    def log_if_successful(message, *args):
+        def callback(future):
+            if future.exception() is None:
+                log.info(message, *args)
+        return callback
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        dump_task = executor.submit(dump_database)
+        dump_task.add_done_callback(log_if_successful("Backed up database: %s", config["db_name"]))
+        backup_tasks = {dump_task: "Unable to back up database."}
+        archive_task = None
+        if full_backup:
+            log.info("Backing up application files from %s to %s", config["install_path"], backup_path)
+            archive_task = executor.submit(archive_install, config["install_path"],
+                                           backup_path + version_code + "_backup", start_backup_process)
+            archive_task.add_done_callback(log_if_successful("Created backup archive in: %s", backup_path))
+            backup_tasks[archive_task] = "Unable to zip and back up the current installation."
+        log.info("Copying needed files for restore from %s to %s", config["install_path"], backup_path)
+        copy_task = executor.submit(copy_needed_files)
+        copy_task.add_done_callback(log_if_successful("Copied needed files for restore."))
+        backup_tasks[copy_task] = "Unable to copy needed files."
+        done, not_done = wait(backup_tasks, return_when=FIRST_EXCEPTION)
+        if not_done:
+            # another step already failed: stop the dump and archive processes, then let the copies finish
+            stop_backup_processes()
+            wait(not_done)
+
+    failed = False
+    for task, error_message in backup_tasks.items():
+        e = task.exception()
+        if e is None:
+            continue
+        failed = True
+        command_output = (e.stderr or e.output) if isinstance(e, subprocess.CalledProcessError) else None
+        if command_output is not None and command_output != b"":
+            log.error("%s Now exiting. Full error: %s and command output: %s", error_message, e, command_output)
+        else:
+            log.error("%s Now exiting. Full error: %s", error_message, e)
+    if failed:
+        exit(1)
+    archive = archive_task.result() if archive_task is not None else None
+    backup_files = copy_task.result()
+
+    log.info("Writing backup manifest: %smanifest.json", backup_path)
+    try:
+        manifest = {"version_code": version_code,
+                    "new_version": new_version,
+                    "release_zip": filename_on_disk,
+                    "release_zip_sha256": zip_sha256,
+                    "files": backup_files,
+                    "archive": archive}
+        with open(backup_path + "manifest.json", "w", buffering=BUFFER_SIZE) as f:
+            json.dump(manifest, f, indent=4)
+    except Exception as e:
+        log.error("Unable to write backup manifest. Now exiting. Full error: %s", e)
+        exit(1)
+
+    # the extracted tree is about to be moved into the install, so it must not be reused by a later run
+    try:
+        download_cache = load_cache(DOWNLOAD_CACHE_PATH)
+        if download_cache.pop("extracted_to", None) is not None:
+            save_cache(DOWNLOAD_CACHE_PATH, download_cache)
     except Exception as e:
-        log.error("Unable to copy needed files. Now exiting. Full error: " + str(e))
+        log.error("Unable to update download cache %s. Now exiting. Full error: %s", DOWNLOAD_CACHE_PATH, e)
         exit(1)
 
-    log.info("Deleting existing application files from " + config["install_path"])
+    log.info("Deleting existing application files from %s", config["install_path"])
     try:
         shutil.rmtree(config["install_path"], ignore_errors=False, onerror=None)
     except Exception as e:
-        log.error("Unable to delete existing application files. Now exiting. Full error: " + str(e))
+        log.error("Unable to delete existing application files. Now exiting. Full error: %s", e)
         exit(1)
 
-    log.info("Moving new application files to " + config["install_path"])
+    log.info("Moving new application files to %s", config["install_path"])
     try:
-        # delete upload directory since it"s getting replaced
-        shutil.rmtree("ls_downloads/" + new_version + "/limesurvey/upload")
         shutil.move("ls_downloads/" + new_version + "/limesurvey",
                     config["install_path"],
-                    copy_function=shutil.copy2)
+                    copy_function=copy_file)
     except Exception as e:
-        log.error("Unable to move new application files. Now exiting. Full error: " + str(e))
+        log.error("Unable to move new application files. Now exiting. Full error: %s", e)
         exit(1)
 
-    log.info("Restoring needed files from " + backup_path + " to " + config["install_path"])
+    log.info("Restoring needed files from %s to %s", backup_path, config["install_path"])
     try:
+        # shutil.move renames when it can and only falls back to copying on errors such as EXDEV
         shutil.move(backup_path + "upload",
-                    config["install_path"],
-                    copy_function=shutil.copy2)
+                    config["install_path"] + "/upload",
+                    copy_function=copy_file)
         shutil.move(backup_path + "config.php",
-                    config["install_path"] + "/application/config/",
-                    copy_function=shutil.copy2)
+                    config["install_path"] + "/application/config/config.php",
+                    copy_function=copy_file)
         if major_version > 3:
             # the security file is only present in 4.x+
             shutil.move(backup_path + "security.php",
-                        config["install_path"] + "/application/config/",
-                        copy_function=shutil.copy2)
+                        config["install_path"] + "/application/config/security.php",
+                        copy_function=copy_file)
     except Exception as e:
-        log.error("Unable to restore existing application files. Now exiting. Full error: " + str(e))
+        log.error("Unable to restore existing application files. Now exiting. Full error: %s", e)
         exit(1)
 
-    log.info("Setting ownership of install path: " + config["install_path"] + " to owner: " + config["install_owner"])
+    log.info("Setting ownership of install path: %s to owner: %s and applying octal permissions: %o",
+             config["install_path"], config["install_owner"], config["install_octal_permissions"])
     try:
-        subprocess.run(["chown", "-R", config["install_owner"], config["install_path"]], capture_output=True,
-                       check=True)
-    except subprocess.CalledProcessError as e:
-        if e.output is not None and e.output != b"":
-            log.error(
-                "Unable to apply ownership. Now exiting. Full error: " + str(e) + " and command output: " + str(
-                    e.output))
-        else:
-            log.error("Unable to apply ownership. Now exiting. Full error: " + str(e))
+        uid, gid = parse_owner(config["install_owner"])
+        apply_ownership_and_permissions(config["install_path"], uid, gid, config["install_octal_permissions"])
+    except Exception as e:
+        log.error("Unable to apply ownership and octal permissions. Now exiting. Full error: %s", e)
         exit(1)
 
-    log.info("Applying octal permissions: " + config["install_octal_permissions"]
-             + " to install path: " + config["install_path"])
+    log.info("Starting web server service: %s with init system: %s",
+             config["web_server_service"], config["web_server_init_system"])
     try:
-        subprocess.run(["chmod", "-R", config["install_octal_permissions"], config["install_path"]],
+        subprocess.run(INIT_SYSTEM_COMMANDS[config["web_server_init_system"]](config["web_server_service"], "start"),
                        capture_output=True, check=True)
+        log.info("Started web server. Check your LimeSurvey install now.")
     except subprocess.CalledProcessError as e:
         if e.output is not None and e.output != b"":
-            log.error(
-                "Unable to apply octal permissions. Now exiting. Full error: " + str(e)
-                + " and command output: " + str(e.output))
+            log.error("Unable to start web server cleanly. Now exiting. Full error: %s and command output: %s",
+                      e, e.output)
         else:
-            log.error("Unable to apply octal permissions. Now exiting. Full error: " + str(e))
+            log.error("Unable to start web server cleanly. Now exiting. Full error: %s", e)
         exit(1)
 
-    log.info("Starting web server service: " + config["web_server_service"]
-             + " with init system: " + config["web_server_init_system"])
     try:
-        if config["web_server_init_system"] in ["systemd", "systemctl"]:
-            subprocess.run(["systemctl", "start", config["web_server_service"]], capture_output=True, check=True)
-        elif config["web_server_init_system"] in ["service", "generic"]:
-            subprocess.run(["service", config["web_server_service"], "start"], capture_output=True, check=True)
-        elif config["web_server_init_system"] in ["init.d", "openrc"]:
-            subprocess.run(["/etc/init.d/" + config["web_server_service"], "start"], capture_output=True, check=True)
-        elif config["web_server_init_system"] == "rc.d":
-            subprocess.run(["/etc/rc.d/" + config["web_server_service"], "start"], capture_output=True, check=True)
-        elif config["web_server_init_system"] in ["upstart", "finit", "initctl"]:
-            subprocess.run(["initctl", "start", config["web_server_service"]], capture_output=True, check=True)
-        elif config["web_server_init_system"] == "epoch":
-            subprocess.run(["epoch", "start", config["web_server_service"]], capture_output=True, check=True)
-        log.info("Started web server. Check your LimeSurvey install now.")
-    except subprocess.CalledProcessError as e:
-        if e.output is not None and e.output != b"":
-            log.error(
-                "Unable to start web server cleanly. Now exiting. Full error: " + str(e)
-                + " and command output: " + str(e.output))
-        else:
-            log.error("Unable to start web server cleanly. Now exiting. Full error: " + str(e))
-        exit(1)
+        save_listing_cache(page, new_version, config["branch"])
+    except Exception as e:
+        log.info("Unable to cache releases page validators. Full error: %s", e)
 
 
 if __name__ == "__main__":